@@ -6,17 +6,22 @@ Includes auto-discovery of SoundTouch devices on the local network.
 """
 
 import http.server
-import socketserver
+import http.client
 import urllib.request
-import urllib.error
+import urllib.parse
 import socket
+import select
+import errno
 import struct
 import sys
 import os
+import shutil
 import json
+import ipaddress
 import threading
 import time
-import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 
 # Parse command-line arguments
 import argparse
@@ -35,60 +40,126 @@ if not device_ips:
         device_ips = [ip.strip() for ip in env_val.split(',') if ip.strip()]
 
 current_device_ip = device_ips[0] if device_ips else None
+current_device_lock = threading.Lock()
 SOUNDTOUCH_PORT = 8090
 PORT = args.port
 
-# Store discovered devices
+# Store discovered devices (guarded by discovery_lock)
 discovered_devices = {}
 discovery_lock = threading.Lock()
 
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+SSDP_MX = 2  # Responders delay their reply by a random 0-MX seconds
 
-def discover_soundtouch_devices(timeout=3):
+# SSDP M-SEARCH message for UPnP devices
+SSDP_REQUEST = (
+    "M-SEARCH * HTTP/1.1\r\n"
+    f"HOST: {SSDP_ADDR}:{SSDP_PORT}\r\n"
+    "MAN: \"ssdp:discover\"\r\n"
+    f"MX: {SSDP_MX}\r\n"
+    "ST: urn:schemas-upnp-org:device:MediaRenderer:1\r\n"
+    "\r\n"
+).encode()
+
+# connect_ex() results that mean a non-blocking connect has started
+# (Windows uses its own code)
+CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK}
+if hasattr(errno, 'WSAEWOULDBLOCK'):
+    CONNECT_IN_PROGRESS.add(errno.WSAEWOULDBLOCK)
+
+# Discovery in progress, shared by concurrent /discover requests
+discovery_future = None
+discovery_executor = ThreadPoolExecutor(max_workers=1)
+
+# Cache of /info results keyed by device IP: ip -> (timestamp, info)
+DEVICE_INFO_TTL = 60
+device_info_cache = {}
+device_info_cache_lock = threading.Lock()
+
+# Endpoints the controller polls continuously; their requests are not logged
+POLLING_PATHS = ('/api/now_playing', '/api/volume')
+
+# Compact JSON encoder reused for every JSON response
+json_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+# Device response headers that are not passed through to the browser
+UNFORWARDED_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'server', 'date'}
+
+# Idle keep-alive connections to SoundTouch devices, keyed by device IP
+connection_pool = {}
+connection_pool_lock = threading.Lock()
+
+
+def get_local_ip():
     """
-    Discover SoundTouch devices using SSDP (Simple Service Discovery Protocol).
+    Get the IP address of the interface used to reach the local network, or None.
     """
-    global discovered_devices
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        local_ip = s.getsockname()[0]
+        s.close()
+        return local_ip
+    except:
+        return None
 
-    SSDP_ADDR = "239.255.255.250"
-    SSDP_PORT = 1900
 
-    # SSDP M-SEARCH message for UPnP devices
-    ssdp_request = (
-        "M-SEARCH * HTTP/1.1\r\n"
-        f"HOST: {SSDP_ADDR}:{SSDP_PORT}\r\n"
-        "MAN: \"ssdp:discover\"\r\n"
-        "MX: 2\r\n"
-        "ST: urn:schemas-upnp-org:device:MediaRenderer:1\r\n"
-        "\r\n"
-    )
+def discover_soundtouch_devices(timeout=3, quiet_timeout=0.3):
+    """
+    Discover SoundTouch devices using SSDP (Simple Service Discovery Protocol).
+    Once a Bose device has replied, stops listening when the socket has been
+    quiet for quiet_timeout seconds after the MX reply window has passed,
+    or after timeout seconds at most.
+    """
+    global discovered_devices
 
-    devices = {}
+    candidate_ips = set()
 
     try:
         # Create UDP socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(timeout)
+        try:
+            # Leave room for a burst of replies on a busy network
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        except OSError:
+            pass
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+
+        # Send the multicast out of the interface facing the local network
+        local_ip = get_local_ip()
+        if local_ip:
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(local_ip))
+            except OSError:
+                pass
 
         # Send M-SEARCH request
-        sock.sendto(ssdp_request.encode(), (SSDP_ADDR, SSDP_PORT))
+        sock.sendto(SSDP_REQUEST, (SSDP_ADDR, SSDP_PORT))
 
         start_time = time.time()
-        while time.time() - start_time < timeout:
+        deadline = start_time + timeout
+        reply_window_end = start_time + SSDP_MX
+        got_response = False
+        while True:
+            now = time.time()
+            remaining = deadline - now
+            if remaining <= 0:
+                break
+            if got_response:
+                remaining = min(remaining, max(reply_window_end - now, 0) + quiet_timeout)
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
             try:
                 data, addr = sock.recvfrom(4096)
                 response = data.decode('utf-8', errors='ignore')
 
-                # Check if it's a Bose SoundTouch device
+                # Check if it's a Bose SoundTouch device; query it once listening is done
                 if 'Bose' in response or 'SoundTouch' in response:
-                    ip = addr[0]
-                    # Try to get device info
-                    device_info = get_device_info(ip)
-                    if device_info:
-                        devices[ip] = device_info
+                    candidate_ips.add(addr[0])
+                    got_response = True
 
-            except socket.timeout:
-                break
             except Exception as e:
                 continue
 
@@ -97,6 +168,9 @@ def discover_soundtouch_devices(timeout=3):
     except Exception as e:
         print(f"SSDP discovery error: {e}")
 
+    # Try to get device info
+    devices = get_devices_info(candidate_ips)
+
     # Also try direct scanning of common IP ranges if SSDP finds nothing
     if not devices:
         devices = scan_network_for_soundtouch()
@@ -107,20 +181,31 @@ def discover_soundtouch_devices(timeout=3):
     return devices
 
 
-def scan_network_for_soundtouch(timeout=1):
+def run_discovery(timeout=3):
     """
-    Scan local network for SoundTouch devices by checking port 8090.
+    Run device discovery, joining a discovery that is already in progress
+    instead of starting another one.
     """
-    devices = {}
+    global discovery_future
 
+    with discovery_lock:
+        if discovery_future and not discovery_future.done():
+            future = discovery_future
+        else:
+            future = discovery_future = discovery_executor.submit(discover_soundtouch_devices, timeout)
+
+    return future.result()
+
+
+def scan_network_for_soundtouch(timeout=1, settle_timeout=0.2):
+    """
+    Scan local network for SoundTouch devices by checking port 8090.
+    All connects are made non-blocking from the calling thread and share one
+    timeout. Once a host with the port open is found, waits at most
+    settle_timeout more seconds for others instead of the rest of timeout.
+    """
     # Get local IP to determine network range
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-    except:
-        local_ip = "192.168.1.1"
+    local_ip = get_local_ip() or "192.168.1.1"
 
     # Extract network prefix
     ip_parts = local_ip.split('.')
@@ -128,83 +213,148 @@ def scan_network_for_soundtouch(timeout=1):
 
     print(f"Scanning network {network_prefix}.0/24 for SoundTouch devices...")
 
-    def check_ip(ip):
+    # Sweep the whole subnet at once; only if the process runs out of file
+    # descriptors is the rest swept afterwards, still within the same deadline
+    ips = [f"{network_prefix}.{i}" for i in range(1, 255)]
+    open_ips = []
+    deadline = time.time() + timeout
+    while ips:
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(timeout)
+            probed, found, deadline = probe_port(ips, deadline, settle_timeout)
+        except OSError as e:
+            print(f"Network scan error: {e}")
+            break
+        open_ips.extend(found)
+        ips = ips[probed:]
+
+    # Only query hosts that actually have the SoundTouch port open
+    return get_devices_info(open_ips)
+
+
+def probe_port(ips, deadline, settle_timeout):
+    """
+    Check which hosts accept connections on the SoundTouch port.
+    Starts a non-blocking connect to every host, then waits for all of them at
+    once until the absolute time deadline.
+    Stops opening sockets early if the process runs out of file descriptors.
+    Returns the number of hosts probed, the list of hosts with the port open,
+    and the deadline, shortened to settle_timeout after the first open port.
+    """
+    pending = {}
+    probed = 0
+    open_ips = []
+    try:
+        for ip in ips:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE) and probed:
+                    break
+                raise
+            probed += 1
+            sock.setblocking(False)
             result = sock.connect_ex((ip, SOUNDTOUCH_PORT))
+            if result in CONNECT_IN_PROGRESS:
+                pending[sock] = ip
+            else:
+                sock.close()
+
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            _, writable, _ = select.select([], list(pending), [], remaining)
+            if not writable:
+                break
+            for sock in writable:
+                ip = pending.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    # Devices on the LAN answer almost at once; don't wait out dead hosts
+                    deadline = min(deadline, time.time() + settle_timeout)
+                    open_ips.append(ip)
+                sock.close()
+    finally:
+        for sock in pending:
             sock.close()
 
-            if result == 0:
-                device_info = get_device_info(ip)
-                if device_info:
-                    return ip, device_info
-        except:
-            pass
-        return None
+    return probed, open_ips, deadline
 
-    # Use threading to speed up scanning
-    threads = []
-    results = []
-    results_lock = threading.Lock()
-
-    def check_and_store(ip):
-        result = check_ip(ip)
-        if result:
-            with results_lock:
-                results.append(result)
-
-    for i in range(1, 255):
-        ip = f"{network_prefix}.{i}"
-        t = threading.Thread(target=check_and_store, args=(ip,))
-        t.daemon = True
-        threads.append(t)
-        t.start()
-
-        # Limit concurrent threads
-        if len(threads) >= 50:
-            for t in threads:
-                t.join(timeout=2)
-            threads = []
-
-    # Wait for remaining threads
-    for t in threads:
-        t.join(timeout=2)
-
-    for ip, info in results:
-        devices[ip] = info
 
+def get_devices_info(ips):
+    """
+    Get device information from several SoundTouch devices in parallel.
+    Returns a dict of IP to device info for the devices that answered.
+    """
+    devices = {}
+    ips = list(ips)
+    if ips:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for ip, device_info in zip(ips, executor.map(get_device_info, ips)):
+                if device_info:
+                    devices[ip] = device_info
     return devices
 
 
 def get_device_info(ip):
     """
     Get device information from a SoundTouch device.
+    Results are cached per IP for DEVICE_INFO_TTL seconds.
     """
+    with device_info_cache_lock:
+        cached = device_info_cache.get(ip)
+    if cached and time.time() - cached[0] < DEVICE_INFO_TTL:
+        return cached[1]
+
     try:
         url = f"http://{ip}:{SOUNDTOUCH_PORT}/info"
         req = urllib.request.Request(url)
         with urllib.request.urlopen(req, timeout=2) as response:
-            data = response.read().decode('utf-8')
-
-            # Parse XML to extract name and type
-            name_match = re.search(r'<name>([^<]+)</name>', data)
-            type_match = re.search(r'<type>([^<]+)</type>', data)
-            device_id_match = re.search(r'deviceID="([^"]+)"', data)
-
-            if name_match:
-                return {
-                    'name': name_match.group(1),
-                    'type': type_match.group(1) if type_match else 'Unknown',
-                    'deviceId': device_id_match.group(1) if device_id_match else 'Unknown',
+            root = ET.fromstring(response.read())
+
+            # Extract name, type and device ID from the <info> element
+            name = root.findtext('name')
+            if name:
+                info = {
+                    'name': name,
+                    'type': root.findtext('type') or 'Unknown',
+                    'deviceId': root.get('deviceID', 'Unknown'),
                     'ip': ip
                 }
+                with device_info_cache_lock:
+                    device_info_cache[ip] = (time.time(), info)
+                return info
     except Exception as e:
         pass
 
+    # Don't keep serving stale info for a device that no longer answers
+    with device_info_cache_lock:
+        device_info_cache.pop(ip, None)
     return None
 
 
+def acquire_connection(ip):
+    """
+    Take an idle keep-alive connection to a device out of the pool, or open a new one.
+    Returns the connection and whether it was reused.
+    """
+    with connection_pool_lock:
+        conn = connection_pool.pop(ip, None)
+    if conn:
+        return conn, True
+    return http.client.HTTPConnection(ip, SOUNDTOUCH_PORT, timeout=10), False
+
+
+def release_connection(ip, conn):
+    """
+    Return a connection to the pool once its response has been fully read.
+    """
+    with connection_pool_lock:
+        idle = connection_pool.get(ip)
+        connection_pool[ip] = conn
+    if idle:
+        idle.close()
+
+
 # Pre-populate discovered_devices with any provided IPs
 for _ip in device_ips:
     info = get_device_info(_ip)
@@ -214,22 +364,31 @@ for _ip in device_ips:
         discovered_devices[_ip] = {'name': _ip, 'type': 'Unknown', 'deviceId': 'Unknown', 'ip': _ip}
 
 
+def get_current_device_ip():
+    """
+    Get the IP of the currently selected device.
+    """
+    with current_device_lock:
+        return current_device_ip
+
+
 class ProxyHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
-        global current_device_ip
-
         # Discovery endpoint
         if self.path == '/discover':
             self.handle_discovery()
         # Get current device
         elif self.path == '/current-device':
-            self.send_json_response({'ip': current_device_ip, 'devices': discovered_devices})
+            with discovery_lock:
+                devices = dict(discovered_devices)
+            self.send_json_response({'ip': get_current_device_ip(), 'devices': devices})
         # Proxy API requests to SoundTouch
         elif self.path.startswith('/api/'):
-            if not current_device_ip:
+            device_ip = get_current_device_ip()
+            if not device_ip:
                 self.send_error(400, "No device selected. Please discover and select a device first.")
                 return
-            self.proxy_request('GET')
+            self.proxy_request('GET', device_ip)
         else:
             # Serve static files
             super().do_GET()
@@ -242,27 +401,57 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length).decode('utf-8')
             data = json.loads(body)
-            current_device_ip = data.get('ip')
-            print(f"Device set to: {current_device_ip}")
-            self.send_json_response({'success': True, 'ip': current_device_ip})
+            device_ip = data.get('ip')
+            if not self.check_device(device_ip):
+                return
+            with current_device_lock:
+                current_device_ip = device_ip
+            with device_info_cache_lock:
+                device_info_cache.clear()
+            print(f"Device set to: {device_ip}")
+            self.send_json_response({'success': True, 'ip': device_ip})
         elif self.path.startswith('/api/'):
-            if not current_device_ip:
+            device_ip = get_current_device_ip()
+            if not device_ip:
                 self.send_error(400, "No device selected")
                 return
-            self.proxy_request('POST')
+            self.proxy_request('POST', device_ip)
         else:
             self.send_error(404)
 
+    def check_device(self, ip):
+        """
+        Check that ip is a known SoundTouch device, or a valid IPv4 address of
+        one that answers /info (e.g. a zone member SSDP missed), which is then
+        recorded. Sends an error response and returns False otherwise.
+        """
+        with discovery_lock:
+            if ip in discovered_devices:
+                return True
+        # Reject malformed addresses before spending a connect timeout on them
+        try:
+            ipaddress.IPv4Address(ip)
+        except ValueError:
+            self.send_error(400, f"Invalid device address: {ip}")
+            return False
+        device_info = get_device_info(ip)
+        if not device_info:
+            self.send_error(403, f"Not a SoundTouch device: {ip}")
+            return False
+        with discovery_lock:
+            discovered_devices[ip] = device_info
+        return True
+
     def handle_discovery(self):
         """Handle device discovery request."""
         print("Starting device discovery...")
-        devices = discover_soundtouch_devices(timeout=3)
+        devices = run_discovery(timeout=3)
         print(f"Found {len(devices)} device(s)")
         self.send_json_response(devices)
 
     def send_json_response(self, data):
         """Send a JSON response."""
-        response = json.dumps(data).encode('utf-8')
+        response = json_encode(data).encode('ascii')
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
@@ -270,44 +459,79 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(response)
 
-    def proxy_request(self, method):
-        global current_device_ip
-
+    def proxy_request(self, method, device_ip):
         # Remove /api prefix and check for device parameter
-        path = self.path[4:]  # Remove '/api'
-
-        # Check if a specific device IP is specified via query param
-        target_ip = current_device_ip
-        if '?device=' in path:
-            path, device_ip = path.split('?device=')
-            target_ip = device_ip.split('&')[0]  # Handle additional params
-
-        url = f"http://{target_ip}:{SOUNDTOUCH_PORT}{path}"
-
+        path, _, query = self.path[4:].partition('?')  # Remove '/api'
+
+        # Check if a specific device IP is specified via query param, and
+        # pass any other params through to the device unchanged
+        target_ip = device_ip
+        params = []
+        for param in query.split('&') if query else []:
+            name, _, value = param.partition('=')
+            if name == 'device':
+                target_ip = urllib.parse.unquote(value)
+            else:
+                params.append(param)
+        if params:
+            path += '?' + '&'.join(params)
+
+        # Only proxy to the selected device or to a SoundTouch device
+        if target_ip != device_ip and not self.check_device(target_ip):
+            return
+
+        conn = None
+        headers_sent = False
         try:
             # Read request body for POST
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length) if content_length > 0 else None
 
-            # Create request
-            req = urllib.request.Request(url, data=body, method=method)
-            req.add_header('Content-Type', 'application/xml')
+            # Forward request over a keep-alive connection, retrying once if
+            # a pooled connection was closed by the device in the meantime
+            for attempt in range(2):
+                conn, reused = acquire_connection(target_ip)
+                try:
+                    conn.request(method, path, body=body, headers={'Content-Type': 'application/xml'})
+                    response = conn.getresponse()
+                    break
+                except (http.client.BadStatusLine, ConnectionError):
+                    conn.close()
+                    if not reused or attempt:
+                        raise
+
+            # Forward the device's headers as-is, minus the ones that only
+            # apply to the device connection or that send_response sets itself
+            self.send_response(response.status)
+            for header, value in response.getheaders():
+                if header.lower() not in UNFORWARDED_HEADERS:
+                    self.send_header(header, value)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            headers_sent = True
+
+            # Stream the body through instead of buffering it in memory
+            shutil.copyfileobj(response, self.wfile, length=16384)
+            release_connection(target_ip, conn)
 
-            # Forward request
-            with urllib.request.urlopen(req, timeout=10) as response:
-                response_body = response.read()
-
-                self.send_response(response.status)
-                self.send_header('Content-Type', 'application/xml')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Content-Length', len(response_body))
-                self.end_headers()
-                self.wfile.write(response_body)
-
-        except urllib.error.URLError as e:
-            self.send_error(502, f"Error connecting to SoundTouch: {e}")
         except Exception as e:
-            self.send_error(500, f"Proxy error: {e}")
+            if conn:
+                conn.close()
+            if headers_sent:
+                # Too late for an error response; cut the truncated body off instead
+                self.close_connection = True
+                self.log_error("Error streaming response from SoundTouch: %s", e)
+            elif isinstance(e, (OSError, http.client.HTTPException)):
+                self.send_error(502, f"Error connecting to SoundTouch: {e}")
+            else:
+                self.send_error(500, f"Proxy error: {e}")
+
+    def copyfile(self, source, outputfile):
+        """Serve static files with sendfile(), avoiding a copy through Python."""
+        if outputfile is self.wfile:
+            self.connection.sendfile(source)
+        else:
+            super().copyfile(source, outputfile)
 
     def do_OPTIONS(self):
         # Handle CORS preflight
@@ -317,11 +541,14 @@ class ProxyHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
 
+    def log_request(self, code='-', size='-'):
+        # Only log non-polling requests, skipping the formatting entirely for polls.
+        # path is not set yet when the request line itself is rejected.
+        if not getattr(self, 'path', '').startswith(POLLING_PATHS):
+            super().log_request(code, size)
+
     def log_message(self, format, *args):
-        # Only log non-polling requests
-        msg = format % args
-        if '/api/now_playing' not in msg and '/api/volume' not in msg:
-            print(f"[{self.log_date_time_string()}] {msg}")
+        print(f"[{self.log_date_time_string()}] {format % args}")
 
 
 # Change to the directory containing the HTML file
@@ -335,10 +562,9 @@ else:
     print("No device specified. Use discovery to find devices.")
 print(f"Open http://localhost:{PORT}/soundtouch-controller-proxy.html in your browser")
 
-# Allow socket reuse
-socketserver.TCPServer.allow_reuse_address = True
-
-with socketserver.TCPServer(("", PORT), ProxyHandler) as httpd:
+# Handle requests concurrently so a running discovery doesn't stall the
+# controller's polling (ThreadingHTTPServer also allows socket reuse)
+with http.server.ThreadingHTTPServer(("", PORT), ProxyHandler) as httpd:
     try:
         httpd.serve_forever()
     except KeyboardInterrupt: